@@ -17,26 +17,45 @@ class Game:
     def get_payoffs(self, x: np.ndarray):
         """x is vector of strategies of len n_players, should have dtype bool (or equivalent)
         True corresponds to risky strategy, False to safe strategy
+        x can also be stacked along leading dimensions to get payoffs for many strategy profiles at once
         """
         # print('s', self.sigma * x + (1-x))
-        safe_proba = (self.sigma * x + (1-x)).prod()
+        safe_proba = (self.sigma * x + (1-x)).prod(axis=-1, keepdims=True)
         # print('p', self.pi * (1-x) + x)
         rewards = self.csf.all_rewards(self.pi * (1 - x) + x)
         return safe_proba * rewards - (1 - safe_proba) * self.d
 
 
 class SymmetricTwoPlayerGame(Game):
+
+    # strategy profiles indexed as [player 0 strategy, player 1 strategy, player]
+    PROFILES = np.array([
+        [[False, False], [False, True]],
+        [[True, False], [True, True]]
+    ])
+
     def __init__(self, pi: float, sigma: float, d: float = 0.0, csf: CSF = CSF()):
         ones = np.ones(2)
         super().__init__(pi * ones, sigma * ones, d * ones, csf)
         self.payoff_matrix = self._get_payoff_matrix()
     
     def _get_payoff_matrix(self):
-        return np.array([
-            [self.get_payoffs(np.array([False, False])), self.get_payoffs(np.array([False, True]))],
-            [self.get_payoffs(np.array([True, False])), self.get_payoffs(np.array([True, True]))]
-        ])
+        return self.get_payoffs(self.PROFILES)
     
+    @classmethod
+    def batch_payoff_matrices(cls, pi, sigmas: np.ndarray, d: float = 0.0, csf: CSF = CSF()):
+        """Payoff matrices for many games at once
+        pi and sigmas are floats or 1d arrays (broadcast against each other)
+        returns array of shape (n, 2, 2, 2), where [i] is the payoff matrix of game i
+        """
+        pi, sigmas = np.broadcast_arrays(np.asarray(pi, dtype=float), np.asarray(sigmas, dtype=float))
+        pi = pi.reshape(-1, 1, 1, 1)
+        sigmas = sigmas.reshape(-1, 1, 1, 1)
+        x = cls.PROFILES
+        safe_proba = (sigmas * x + (1 - x)).prod(axis=-1, keepdims=True)
+        rewards = csf.all_rewards(pi * (1 - x) + x)
+        return safe_proba * rewards - (1 - safe_proba) * d
+
     def find_nash_eqs(self):
         eqs = []
         # check for pure strategy safe eq
@@ -95,28 +114,59 @@ def _plot_helper(
     plt.show()
 
 
+def _nash_masks(pm: np.ndarray, pi, sigmas, d: float):
+    """Which equilibria exist for each game in a batch of symmetric two player games
+    pm is a batch of payoff matrices, as returned by SymmetricTwoPlayerGame.batch_payoff_matrices
+    returns q0 (mixed strategy risky proba), has_safe, has_risky, has_mixed; all have shape (n,)
+    """
+    # check for pure strategy safe & risky eqs
+    has_safe = pm[:, 0, 0, 0] > pm[:, 1, 0, 0]
+    has_risky = pm[:, 1, 1, 0] > pm[:, 0, 1, 0]
+    # check for mixed strategy eq
+    q0 = (pi - 2*sigmas + 1 + 2*d*(pi + 1)*(1 - sigmas)) / ((2*d + 1) * (pi + 1) * (1-sigmas)**2)
+    q0 = np.broadcast_to(q0, has_safe.shape)
+    has_mixed = (0 < q0) & (q0 < 1)
+    return q0, has_safe, has_risky, has_mixed
+
+
+def _sweep_outcomes(pi, sigmas, d: float, csf: CSF):
+    """Same as sweep, but also returns safe_safeties, mixed_safeties, risky_safeties"""
+    pm = SymmetricTwoPlayerGame.batch_payoff_matrices(pi, sigmas, d, csf)
+    q0, has_safe, has_risky, has_mixed = _nash_masks(pm, pi, sigmas, d)
+    sigmas = np.broadcast_to(sigmas, q0.shape)
+    mixed_payoff = (
+        q0 * q0 * pm[:, 1, 1, 0]
+        + q0*(1-q0) * pm[:, 1, 0, 0]
+        + (1 - q0) * q0 * pm[:, 0, 1, 0]
+        + (1-q0) * (1-q0) * pm[:, 0, 0, 0]
+    )
+    mixed_safety = (1 - q0)**2 + 2 * q0 * (1 - q0) * sigmas + q0**2 * sigmas**2
+    return (
+        np.where(has_mixed, q0, np.nan),
+        np.where(has_safe, pm[:, 0, 0, 0], np.nan),
+        np.where(has_mixed, mixed_payoff, np.nan),
+        np.where(has_risky, pm[:, 1, 1, 0], np.nan),
+        np.where(has_safe, 1.0, np.nan),
+        np.where(has_mixed, mixed_safety, np.nan),
+        np.where(has_risky, sigmas**2, np.nan),
+    )
+
+
+def sweep(pi, sigmas, d: float = 0.0, csf: CSF = CSF()):
+    """Nash equilibria for symmetric two player games over many values of pi and/or sigma
+    pi and sigmas are floats or 1d arrays (broadcast against each other)
+    returns mixed_ps, safe_payoffs, mixed_payoffs, risky_payoffs; all have shape (n,)
+    entries are nan where the corresponding equilibrium doesn't exist
+    """
+    return _sweep_outcomes(pi, sigmas, d, csf)[:4]
+
+
 def plot_two_player_varying_sigma(pi: float, sigmas: np.ndarray, d: float, csf: CSF = CSF()):
-    safe_payoffs = np.ones_like(sigmas) * np.nan
-    mixed_payoffs = np.ones_like(sigmas) * np.nan
-    risky_payoffs = np.ones_like(sigmas) * np.nan
-    safe_safeties = np.ones_like(sigmas) * np.nan
-    mixed_safeties = np.ones_like(sigmas) * np.nan
-    risky_safeties = np.ones_like(sigmas) * np.nan
-    for i, sigma in enumerate(sigmas):
-        game = SymmetricTwoPlayerGame(pi, sigma, d, csf)
-        ps = game.find_nash_eqs()
-        payoffs = game.nash_payoffs(ps)
-        safeties = game.nash_safeties(ps)
-        for (p0, _), payoff, safety in zip(ps, payoffs, safeties):
-            if p0 == 1.0:
-                risky_payoffs[i] = payoff
-                risky_safeties[i] = safety
-            elif p0 == 0.0:
-                safe_payoffs[i] = payoff
-                safe_safeties[i] = safety
-            else:
-                mixed_payoffs[i] = payoff
-                mixed_safeties[i] = safety
+    (
+        _,
+        safe_payoffs, mixed_payoffs, risky_payoffs,
+        safe_safeties, mixed_safeties, risky_safeties
+    ) = _sweep_outcomes(pi, sigmas, d, csf)
     _plot_helper(
         sigmas,
         safe_payoffs, mixed_payoffs, risky_payoffs,
@@ -126,27 +176,11 @@ def plot_two_player_varying_sigma(pi: float, sigmas: np.ndarray, d: float, csf:
 
 
 def plot_two_player_varying_pi(pis: np.ndarray, sigma: float, d: float, csf: CSF = CSF()):
-    safe_payoffs = np.ones_like(pis) * np.nan
-    mixed_payoffs = np.ones_like(pis) * np.nan
-    risky_payoffs = np.ones_like(pis) * np.nan
-    safe_safeties = np.ones_like(pis) * np.nan
-    mixed_safeties = np.ones_like(pis) * np.nan
-    risky_safeties = np.ones_like(pis) * np.nan
-    for i, pi in enumerate(pis):
-        game = SymmetricTwoPlayerGame(pi, sigma, d, csf)
-        ps = game.find_nash_eqs()
-        payoffs = game.nash_payoffs(ps)
-        safeties = game.nash_safeties(ps)
-        for (p0, _), payoff, safety in zip(ps, payoffs, safeties):
-            if p0 == 1.0:
-                risky_payoffs[i] = payoff
-                risky_safeties[i] = safety
-            elif p0 == 0.0:
-                safe_payoffs[i] = payoff
-                safe_safeties[i] = safety
-            else:
-                mixed_payoffs[i] = payoff
-                mixed_safeties[i] = safety
+    (
+        _,
+        safe_payoffs, mixed_payoffs, risky_payoffs,
+        safe_safeties, mixed_safeties, risky_safeties
+    ) = _sweep_outcomes(pis, sigma, d, csf)
     _plot_helper(
         pis,
         safe_payoffs, mixed_payoffs, risky_payoffs,
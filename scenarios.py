@@ -1,13 +1,17 @@
 import numpy as np
+import matplotlib
+# plots are only ever saved to file, so use a non-interactive backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
 from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
 from typing import Callable, Tuple
 
 # set active directory to location of this file
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
-from simple_model import ProdFunc, CSF, Problem, HybridProblem, MixedProblem
+from simple_model import ProdFunc, CSF, Problem, HybridProblem, MixedProblem, F_batch, all_net_payoffs_batch
 
 # check if cpp backend is available
 if os.path.exists('build/libpybindings.so'):
@@ -32,6 +36,9 @@ DEFAULT_EXIT_TOL = 1e-6
 DEFAULT_NLP_MAX_ITERS = 500
 DEFAULT_NLP_ITER_TOL = 1e-6
 
+# max number of sweep steps sent to a worker in a single task
+MAX_BATCH_SIZE = 16
+
 PLOT_FIGSIZE = (15, 12)
 
 VEC_PARAM_NAMES = ['A', 'alpha', 'B', 'beta', 'theta', 'd', 'r']
@@ -112,6 +119,36 @@ def _cpp_multiproc_helper(args):
     )
 
 
+def _batch_multiproc_helper(args):
+    """
+    Runs one of the multiproc helpers above on a batch of steps
+    params live in shared memory, as an array of shape (n_steps, len(VEC_PARAM_NAMES), n_players);
+    this batch is steps start to stop
+    returns start along with the results, so batches can be put back in order
+    """
+    (
+        _multiproc_helper,
+        n_players,
+        shm_name, shape, start, stop,
+        w, l, a_w, a_l,
+        max_iters, exit_tol, nlp_max_iters, nlp_exit_tol
+    ) = args
+    shm = SharedMemory(name=shm_name)
+    # copy out this batch's (small) slice so shared memory can be released right away
+    params = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)[start:stop].copy()
+    shm.close()
+    return start, [
+        _multiproc_helper((
+            n_players,
+            A_, alpha_, B_, beta_, theta_,
+            d_, r_,
+            w, l, a_w, a_l,
+            max_iters, exit_tol, nlp_max_iters, nlp_exit_tol
+        ))
+        for A_, alpha_, B_, beta_, theta_, d_, r_ in params
+    ]
+
+
 def get_colors(
     n: int,
     color_1: Tuple[float, float, float] = (0., 0.5, 1.), 
@@ -197,6 +234,7 @@ class Scenario:
         self.secondary_varying_param = secondary_varying_param
         self.n_steps = 0
         self.n_steps_secondary = 0
+        self._pool = None  # worker pool, created on first solve and reused until self.close() is called
         # make sure the vector parameters are the right sizes
         for param_name in VEC_PARAM_NAMES:
             param = getattr(self, param_name)
@@ -211,41 +249,79 @@ class Scenario:
             else:
                 assert param.ndim == 1 and len(param) == n_players, "Length of param should match number of players"
     
-    def _solver_helper(self, _multiproc_helper: Callable, param_dict: dict):
-        with Pool(min(cpu_count(), self.n_steps)) as pool:
-            strats = pool.map(
-                _multiproc_helper,
-                [
-                    (
-                        self.n_players,
-                        A_,
-                        alpha_,
-                        B_,
-                        beta_,
-                        theta_,
-                        d_,
-                        r_,
-                        self.w,
-                        self.l,
-                        self.a_w,
-                        self.a_l,
-                        self.max_iters,
-                        self.exit_tol,
-                        self.nlp_max_iters,
-                        self.nlp_exit_tol
-                    )
-                    for A_, alpha_, B_, beta_, theta_, d_, r_ in zip(
-                        param_dict['A'],
-                        param_dict['alpha'],
-                        param_dict['B'],
-                        param_dict['beta'],
-                        param_dict['theta'],
-                        param_dict['d'],
-                        param_dict['r']
-                    )
-                ]
-            )
-        return strats
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def __del__(self):
+        self.close()
+    
+    def close(self):
+        """Shuts down the worker pool, if one has been started"""
+        if getattr(self, '_pool', None) is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+    
+    def _get_pool(self, n_workers: int):
+        if self._pool is None:
+            self._pool = Pool(n_workers)
+        return self._pool
+    
+    def _get_params(self) -> np.ndarray:
+        """
+        Stacks the vector params into a single array of shape (n_steps, len(VEC_PARAM_NAMES), n_players),
+        or (n_steps_secondary, n_steps, len(VEC_PARAM_NAMES), n_players) if there is a secondary varying param
+        """
+        shape = (self.n_steps, len(VEC_PARAM_NAMES), self.n_players)
+        if self.n_steps_secondary != 0:
+            shape = (self.n_steps_secondary,) + shape
+        params = np.empty(shape)
+        for i, param_name in enumerate(VEC_PARAM_NAMES):
+            if param_name == self.varying_param:
+                params[..., i, :] = getattr(self, param_name).reshape(-1, 1)
+            elif param_name == self.secondary_varying_param:
+                params[..., i, :] = getattr(self, param_name).reshape(-1, 1, self.n_players)
+            else:
+                params[..., i, :] = getattr(self, param_name)
+        return params
+    
+    def _solver_helper(self, _multiproc_helper: Callable, params: np.ndarray):
+        n_workers = min(cpu_count(), self.n_steps)
+        # send several steps to each worker at once so process overhead is amortized over multiple solves,
+        # but keep batches small enough that long sweeps are spread evenly over workers
+        batch_size = max(1, min(self.n_steps // (4 * n_workers), MAX_BATCH_SIZE))
+        # params are passed to workers via shared memory rather than pickled with each task
+        shm = SharedMemory(create=True, size=params.nbytes)
+        try:
+            np.ndarray(params.shape, dtype=np.float64, buffer=shm.buf)[:] = params
+            batches = [
+                (
+                    _multiproc_helper,
+                    self.n_players,
+                    shm.name,
+                    params.shape,
+                    start,
+                    start + batch_size,
+                    self.w,
+                    self.l,
+                    self.a_w,
+                    self.a_l,
+                    self.max_iters,
+                    self.exit_tol,
+                    self.nlp_max_iters,
+                    self.nlp_exit_tol
+                )
+                for start in range(0, self.n_steps, batch_size)
+            ]
+            # collect batches in whatever order they finish
+            strats = dict(self._get_pool(n_workers).imap_unordered(_batch_multiproc_helper, batches))
+        finally:
+            shm.close()
+            shm.unlink()
+        return [strat for start in sorted(strats) for strat in strats[start]]
     
     def _plot_helper(
         self,
@@ -259,94 +335,66 @@ class Scenario:
     ):
         xvar = getattr(self, self.varying_param)
         fig, axs = plt.subplots(2, 2, figsize=PLOT_FIGSIZE)
-        # plot performance
-        if labels is None:
-            axs[0, 0].plot(xvar, p.mean(axis=-1), logscale)
-        else:
-            for i in range(self.n_players):
-                axs[0, 0].plot(xvar, p[:, i], label=labels[i])
-            axs[0, 0].legend()
-        axs[0, 0].set_ylabel('performance')
-        axs[0, 0].set_xlabel(self.varying_param)
-        # plt.xlabel(self.varying_param)
-        # plt.savefig(f'plots/{plotname}_performance.png')
-        # plt.clf()
-        # plot safety
-        if labels is None:
-            axs[0, 1].plot(xvar, s.mean(axis=-1))
-        else:
-            for i in range(self.n_players):
-                axs[0, 1].plot(xvar, s[:, i], label=labels[i])
-            axs[0, 1].legend()
-        axs[0, 1].set_ylabel('safety')
-        axs[0, 1].set_xlabel(self.varying_param)
-        # plt.xlabel(self.varying_param)
-        # plt.savefig(f'plots/{plotname}_safety.png')
-        # plt.clf()
+        total_proba = (s / (1 + s)).prod(axis=-1)
+        # (axis, values to plot, y axis label)
+        plots = (
+            (axs[0, 0], p, 'performance'),
+            (axs[0, 1], s, 'safety'),
+            (axs[1, 0], total_proba, 'Proba of safe outcome'),
+            (axs[1, 1], payoffs, 'net payoff'),
+        )
+        for ax, yvar, ylabel in plots:
+            if yvar.ndim == 1:
+                ax.plot(xvar, yvar)
+            elif labels is None:
+                ax.plot(xvar, yvar.mean(axis=-1))
+            else:
+                for i in range(self.n_players):
+                    ax.plot(xvar, yvar[:, i], label=labels[i])
+                ax.legend()
+            ax.set_ylabel(ylabel)
+            ax.set_xlabel(self.varying_param)
         if logscale:
             axs[0, 0].semilogy()
             axs[0, 1].semilogy()
-        # plot total disaster proba
-        probas = s / (1 + s)
-        total_proba = probas.prod(axis=-1)
-        axs[1, 0].plot(xvar, total_proba)
-        axs[1, 0].set_ylabel('Proba of safe outcome')
-        axs[1, 0].set_xlabel(self.varying_param)
-        # plt.xlabel(self.varying_param)
-        # plt.savefig(f'plots/{plotname}_total_safety.png')
-        # plt.clf()
-        # plot net payoffs
-        if labels is None:
-            axs[1, 1].plot(xvar, payoffs.mean(axis=-1))
-        else:
-            for i in range(self.n_players):
-                axs[1, 1].plot(xvar, payoffs[:, i], label=labels[i])
-            axs[1, 1].legend()
-        axs[1, 1].set_ylabel('net payoff')
-        axs[1, 1].set_xlabel(self.varying_param)
 
         if title is not None:
             fig.suptitle(title)
-        plt.savefig(f'plots/{plotname}.png')
-        plt.clf()
+        fig.savefig(f'plots/{plotname}.png')
+        plt.close(fig)
         
     def _solve_cpp(
         self,
-        param_dict: dict,
+        params: np.ndarray,
         plot: bool,
         plotname: str = 'scenario',
         labels: list = None,
         title: str = None,
         logscale: bool = False
     ):
-        strats = self._solver_helper(_cpp_multiproc_helper, param_dict)
-        # get s and p for each strategy
-        s_p = np.array([
-            prod_F(
+        strats = self._solver_helper(_cpp_multiproc_helper, params)
+        # cpp solver output is a transposed view of a (2, n_players) array, so this doesn't copy;
+        # rows of the transposed strats can be passed straight to the cpp bindings
+        strats_T = [np.ascontiguousarray(strat.T) for strat in strats]
+        # get s, p and payoffs for each strategy
+        s = np.empty((self.n_steps, self.n_players))
+        p = np.empty((self.n_steps, self.n_players))
+        payoffs = np.empty((self.n_steps, self.n_players))
+        for i, (strat_T, (A_, alpha_, B_, beta_, theta_, d_, r_)) in enumerate(zip(strats_T, params)):
+            s[i], p[i] = prod_F(
                 self.n_players,
-                strat[:, 0].copy(),
-                strat[:, 1].copy(),
+                strat_T[0],
+                strat_T[1],
                 A_,
                 alpha_,
                 B_,
                 beta_,
                 theta_
             )
-            for strat, A_, alpha_, B_, beta_, theta_ in zip(
-                strats,
-                param_dict['A'],
-                param_dict['alpha'],
-                param_dict['B'],
-                param_dict['beta'],
-                param_dict['theta']
-            )
-        ])
-        s, p = s_p[:, 0, :], s_p[:, 1, :]
-        payoffs = np.array([
-            get_payoffs(
+            payoffs[i] = get_payoffs(
                 self.n_players,
-                strat[:, 0].copy(),
-                strat[:, 1].copy(),
+                strat_T[0],
+                strat_T[1],
                 A_,
                 alpha_,
                 B_,
@@ -357,19 +405,8 @@ class Scenario:
                 W=self.w,
                 L=self.l,
                 a_w=self.a_w,
-                a_l=self.a_w,
+                a_l=self.a_l,
             )
-            for strat, A_, alpha_, B_, beta_, theta_, d_, r_ in zip(
-                strats,
-                param_dict['A'],
-                param_dict['alpha'],
-                param_dict['B'],
-                param_dict['beta'],
-                param_dict['theta'],
-                param_dict['d'],
-                param_dict['r']
-            )
-        ])
         if plot:
             self._plot_helper(s, p, payoffs, plotname, labels, title, logscale)
         return strats, s, p, payoffs
@@ -377,53 +414,28 @@ class Scenario:
 
     def _solve_python(
         self,
-        param_dict: dict,
+        params: np.ndarray,
         plot: bool,
         plotname: str = 'scenario',
         labels: list = None,
         title: str = None,
         logscale: bool = False
     ):
-        strats = self._solver_helper(_python_multiproc_helper, param_dict)
-        # get s and p for each strategy
-        prodFuncs = [
-            ProdFunc(A_, alpha_, B_, beta_, theta_)
-            for A_, alpha_, B_, beta_, theta_ in zip(
-                param_dict['A'],
-                param_dict['alpha'],
-                param_dict['B'],
-                param_dict['beta'],
-                param_dict['theta']
-            )
-        ]
-        s_p = np.array([
-            prodFunc.F(strat[:, 0], strat[:, 1])
-            for prodFunc, strat in zip(prodFuncs, strats)
-        ])
-        s, p = s_p[:, 0, :], s_p[:, 1, :]
-        # get payoffs for each strategy
-        problems = [
-            MixedProblem(
-                param_dict['d'][i],
-                param_dict['r'][i],
-                prodFunc,
-                CSF(self.w, self.l, self.a_w, self.a_l)
-            )
-            for i, prodFunc in enumerate(prodFuncs)
-        ]
-        payoffs = np.array([
-            problem.all_net_payoffs(
-                strat[:, 0], strat[:, 1]
-            )
-            for strat, problem in zip(strats, problems)
-        ])
+        strats = self._solver_helper(_python_multiproc_helper, params)
+        # get s, p and payoffs for each strategy, all steps at once
+        stacked_strats = np.stack(strats)
+        Ks, Kp = stacked_strats[..., 0], stacked_strats[..., 1]
+        A, alpha, B, beta, theta, d, r = params.transpose(1, 0, 2)
+        s, p = F_batch(Ks, Kp, A, alpha, B, beta, theta)
+        csf = CSF(self.w, self.l, self.a_w, self.a_l)
+        payoffs = all_net_payoffs_batch(Ks, Kp, A, alpha, B, beta, theta, d, r, csf)
         if plot:
             self._plot_helper(s, p, payoffs, plotname, labels, title, logscale)
         return strats, s, p, payoffs
     
     def _solve_roots(
         self,
-        param_dict: dict,
+        params: np.ndarray,
         plot: bool,
         plotname: str = 'scenario',
         labels: list = None,
@@ -431,7 +443,7 @@ class Scenario:
         logscale: bool = False
     ):
         strats, s, p, payoffs = tuple(
-            np.array(x) for x in zip(*self._solver_helper(_roots_multiproc_helper, param_dict))
+            np.stack(x) for x in zip(*self._solver_helper(_roots_multiproc_helper, params))
         )
         if plot:
             self._plot_helper(s, p, payoffs, plotname, labels, title, logscale)
@@ -439,7 +451,7 @@ class Scenario:
     
     def _solve_hybrid(
         self,
-        param_dict: dict,
+        params: np.ndarray,
         plot: bool,
         plotname: str = 'scenario',
         labels: list = None,
@@ -447,7 +459,7 @@ class Scenario:
         logscale: bool = False
     ):
         strats, s, p, payoffs = tuple(
-            np.array(x) for x in zip(*self._solver_helper(_hybrid_multiproc_helper, param_dict))
+            np.stack(x) for x in zip(*self._solver_helper(_hybrid_multiproc_helper, params))
         )
         if plot:
             self._plot_helper(s, p, payoffs, plotname, labels, title, logscale)
@@ -464,29 +476,7 @@ class Scenario:
     ):
         if labels is not None:
             assert len(labels) == self.n_steps_secondary, "Length of labels should match number of secondary variations"
-        param_dicts = [
-            {
-                param_name:
-                np.tile(
-                    getattr(self, param_name),
-                    (self.n_players, 1)
-                ).T.copy()
-                if param_name == self.varying_param
-                else
-                np.tile(
-                    secondary_variation,
-                    (self.n_steps, 1)
-                )
-                if param_name == self.secondary_varying_param
-                else
-                np.tile(
-                    getattr(self, param_name),
-                    (self.n_steps, 1)
-                )
-                for param_name in VEC_PARAM_NAMES
-            }
-            for secondary_variation in getattr(self, self.secondary_varying_param)
-        ]
+        params = self._get_params()
         solver = (
             self._solve_cpp if method == 'cpp'
             else self._solve_python if method == 'python'
@@ -494,7 +484,7 @@ class Scenario:
             else self._solve_hybrid
         )
         strats_list, s_list, p_list, payoffs_list = tuple(zip(*[
-            solver(param_dict, plot = False) for param_dict in param_dicts
+            solver(params_, plot = False) for params_ in params
         ]))
         if plot:
             fig, axs = plt.subplots(2, 2, figsize=PLOT_FIGSIZE)
@@ -504,56 +494,34 @@ class Scenario:
                 np.isclose(s.T, s[:, 0], rtol=0.01).all() and np.isclose(p.T, p[:, 0], rtol=0.01).all()
                 for s, p in zip(s_list, p_list)
             ))
-            # plot performance
-            _multivar_plot_helper(
-                labels,
-                p_list,
-                axs[0, 0],
-                xvar, self.varying_param,
-                'performance',
-                colors,
-                combine
-            )
-            # plot safety
-            _multivar_plot_helper(
-                labels,
-                s_list,
-                axs[0, 1],
-                xvar, self.varying_param,
-                'safety',
-                colors,
-                combine
+            total_proba_list = [(s / (1 + s)).prod(axis=-1) for s in s_list]
+            # (axis, values to plot, y axis label)
+            plots = (
+                (axs[0, 0], p_list, 'performance'),
+                (axs[0, 1], s_list, 'safety'),
+                (axs[1, 0], total_proba_list, 'proba of safe outcome'),
+                (axs[1, 1], payoffs_list, 'net payoff'),
             )
+            for ax, yvar_list, ylabel in plots:
+                _multivar_plot_helper(
+                    labels,
+                    yvar_list,
+                    ax,
+                    xvar, self.varying_param,
+                    ylabel,
+                    colors,
+                    combine
+                )
             # set performance and safety plots to log scale
             if logscale:
                 axs[0, 0].semilogy()
                 axs[0, 1].semilogy()
-            # plot total disaster proba
-            total_proba_list = [(s / (1 + s)).prod(axis=-1) for s in s_list]
-            _multivar_plot_helper(
-                labels,
-                total_proba_list,
-                axs[1, 0],
-                xvar, self.varying_param,
-                'proba of safe outcome',
-                colors
-            )
-            # plot net payoffs
-            _multivar_plot_helper(
-                labels,
-                payoffs_list,
-                axs[1, 1],
-                xvar, self.varying_param,
-                'net payoff',
-                colors,
-                combine
-            )
 
             if title is not None:
                 fig.suptitle(title)
-            plt.savefig(f'plots/{plotname}.png')
-            plt.clf()
-        return tuple(np.array(x) for x in (strats_list, s_list, p_list, payoffs_list))
+            fig.savefig(f'plots/{plotname}.png')
+            plt.close(fig)
+        return tuple(np.stack(x) for x in (strats_list, s_list, p_list, payoffs_list))
     
     def solve(
         self,
@@ -569,26 +537,13 @@ class Scenario:
 
         if labels is not None:
             assert len(labels) == self.n_players, "Length of labels should match number of players"
-        # build dict of params to solve over
-        param_dict = {
-            param_name:
-            np.tile(
-                getattr(self, param_name),
-                (self.n_steps, 1)
-            ) 
-            if param_name != self.varying_param
-            else
-            np.tile(
-                getattr(self, param_name),
-                (self.n_players, 1)
-            ).T.copy()  # copy so it remains contiguous in memory
-            for param_name in VEC_PARAM_NAMES
-        }
+        # stack params to solve over
+        params = self._get_params()
         solver = self._solve_cpp if method == 'cpp' \
             else self._solve_python if method == 'python' \
                 else self._solve_roots if method == 'roots' \
                     else self._solve_hybrid
-        return solver(param_dict, plot, plotname, labels, title, logscale)
+        return solver(params, plot, plotname, labels, title, logscale)
 
 
 if __name__ == '__main__':
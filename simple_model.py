@@ -5,6 +5,13 @@ from dataclasses import dataclass
 import warnings
 warnings.filterwarnings('ignore')
 
+# numba is optional; without it the jitted kernels below just run as plain numpy
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda f: f
+
 
 
 SOLVER_TOL = 1e-3
@@ -76,6 +83,20 @@ class ProdFunc:
         return jac
 
 
+def F_batch(Ks, Kp, A, alpha, B, beta, theta):
+    """
+    Same as ProdFunc.F, but with production function params passed explicitly
+
+    params can be stacked along leading dimensions (e.g. with shape (n_steps, n))
+    to evaluate many production functions in a single call
+
+    returns s, p; both are np arrays with the broadcast shape of the inputs
+    """
+    p = B * Kp ** beta
+    s = A * Ks ** alpha * p ** -theta
+    return s, p
+
+
 
 class CSF:
 
@@ -87,46 +108,119 @@ class CSF:
         a_l is reward per unit of p for loser
 
         win proba is p[i] / sum(p)
+
+        all reward methods accept an optional sum_, which should equal p.sum(axis=-1);
+        pass it when calling more than one method with the same p, to avoid recomputing it
         """
         self.w = w
         self.l = l
         self.a_w = a_w
         self.a_l = a_l
+        # constants used in the derivative calculations
+        self._wl = w - l
+        self._al = a_w - a_l
     
-    def reward(self, i: int, p: np.ndarray):
-        win_proba = p[..., i] / p.sum(axis=-1)
+    def reward(self, i: int, p: np.ndarray, sum_: np.ndarray = None):
+        if sum_ is None:
+            sum_ = p.sum(axis=-1)
+        win_proba = p[..., i] / sum_
         return (
             (self.w + p[..., i] * self.a_w) * win_proba
             + (self.l + p[..., i] * self.a_l) * (1 - win_proba)
         )
     
-    def all_rewards(self, p: np.ndarray):
-        win_probas = p / p.sum(axis=-1)
-        return (
-            (self.w + p * self.a_w) * win_probas
-            + (self.l + p * self.a_l) * (1 - win_probas)
-        )
+    def all_rewards(self, p: np.ndarray, sum_: np.ndarray = None):
+        if sum_ is None:
+            sum_ = p.sum(axis=-1)
+        win_probas = p / np.expand_dims(sum_, -1)
+        return self.l + self._wl * win_probas + (self.a_l + self._al * win_probas) * p
     
-    def reward_deriv(self, i: int, p: np.ndarray):
-        sum_ = p.sum(axis=-1)
-        win_proba = p[..., i] / sum_
-        win_proba_deriv = (sum_ - p[..., i]) / sum_**2
+    def reward_deriv(self, i: int, p: np.ndarray, sum_: np.ndarray = None):
+        if sum_ is None:
+            sum_ = p.sum(axis=-1)
+        inv_sum = 1.0 / sum_
+        win_proba = p[..., i] * inv_sum
+        # derivative of win proba is (sum - p) / sum**2 == (1 - win_proba) / sum
         return (
-            self.a_l + (self.a_w - self.a_l) * win_proba
-            + (self.w - self.l + (self.a_w - self.a_l) * p[..., i]) * win_proba_deriv
+            self.a_l + self._al * win_proba
+            + (self._wl + self._al * p[..., i]) * (1 - win_proba) * inv_sum
         )
     
-    def all_reward_derivs(self, p: np.ndarray):
-        sum_ = p.sum(axis=-1)
-        win_probas = p / sum_
-        win_proba_derivs = (sum_ - p) / sum_**2
+    def all_reward_derivs(self, p: np.ndarray, sum_: np.ndarray = None):
+        if sum_ is None:
+            sum_ = p.sum(axis=-1)
+        inv_sum = 1.0 / np.expand_dims(sum_, -1)
+        win_probas = p * inv_sum
+        # derivative of win proba is (sum - p) / sum**2 == (1 - win_proba) / sum
         return (
-            self.a_l + (self.a_w - self.a_l) * win_probas
-            + (self.w - self.l + (self.a_w - self.a_l) * p) * win_proba_derivs
+            self.a_l + self._al * win_probas
+            + (self._wl + self._al * p) * (1 - win_probas) * inv_sum
         )
 
 
 
+# the kernels below use error_model='numpy' so that divisions compile without zero-division checks
+
+@njit(cache=True, error_model='numpy')
+def _all_rewards_jit(p, l, a_l, wl, al, out):
+    """Same as CSF.all_rewards, for 1d p, written to out; wl is w - l, al is a_w - a_l"""
+    sum_ = p.sum()
+    for i in range(p.shape[0]):
+        win_proba = p[i] / sum_
+        out[i] = l + wl * win_proba + (a_l + al * win_proba) * p[i]
+
+
+@njit(cache=True, error_model='numpy')
+def _all_reward_derivs_jit(p, l, a_l, wl, al, out):
+    """Same as CSF.all_reward_derivs, for 1d p, written to out; wl is w - l, al is a_w - a_l"""
+    inv_sum = 1.0 / p.sum()
+    for i in range(p.shape[0]):
+        win_proba = p[i] * inv_sum
+        out[i] = a_l + al * win_proba + (wl + al * p[i]) * (1 - win_proba) * inv_sum
+
+
+@njit(cache=True, error_model='numpy')
+def _roots_jac_jit(x, A, alpha, B, beta, theta, d, r, l, a_l, wl, al):
+    """
+    Compiled version of the function returned by Problem.get_jac, for a single n x 2 array of strategies
+    returns a 2 x n array
+    """
+    Ks = x[:, 0]
+    Kp = x[:, 1]
+    p = B * Kp ** beta
+    s = A * Ks ** alpha * p ** -theta
+    proba = (s / (1 + s)).prod()
+    proba_mult = proba / (s * (1 + s))
+    # s_mult is ds/dKs if theta = 0, p_mult is dp/dKp
+    s_mult = A * alpha * (s / A) ** (1 - 1 / alpha)
+    p_mult = B * beta * (p / B) ** (1 - 1 / beta)
+    s_ks = s_mult * p ** -theta
+    s_kp = -theta * s * p ** (-theta - 1) * p_mult
+    R_ = np.empty_like(p)
+    R_deriv_ = np.empty_like(p)
+    _all_rewards_jit(p, l, a_l, wl, al, R_)
+    _all_reward_derivs_jit(p, l, a_l, wl, al, R_deriv_)
+    out = np.empty((2, x.shape[0]))
+    # dp/dKs is always 0
+    out[0] = proba_mult * s_ks * (R_ + d) - r
+    out[1] = proba_mult * s_kp * (R_ + d) + proba * R_deriv_ * p_mult - r
+    return out
+
+
+
+def all_net_payoffs_batch(Ks, Kp, A, alpha, B, beta, theta, d, r, csf: CSF = CSF()):
+    """
+    Same as Problem.all_net_payoffs, but with problem params passed explicitly
+
+    params can be stacked along leading dimensions (e.g. with shape (n_steps, n))
+    to evaluate payoffs for many problems (sharing the same csf) in a single call
+    """
+    s, p = F_batch(Ks, Kp, A, alpha, B, beta, theta)
+    proba = (s / (1 + s)).prod(axis=-1, keepdims=True)
+    return proba * csf.all_rewards(p) - (1 - proba) * d - r * (Ks + Kp)
+
+
+
 @dataclass
 class SolverResult:
     success: bool
@@ -201,20 +295,13 @@ class Problem:
         return proba * self.csf.reward(i, p) - (1 - proba) * self.d[i] - self.r[i] * (Ks[..., i] + Kp[..., i])
     
     def all_net_payoffs(self, Ks: np.ndarray, Kp: np.ndarray):
-        """Basically just runs self.net_payoff for all the i"""
+        """
+        Basically just runs self.net_payoff for all the i
+        Ks and Kp can have any number of leading dimensions; last dimension should have length self.n
+        """
         s, p = self.prodFunc.F(Ks, Kp)
-        proba = (s / (1 + s)).prod(axis=-1)
-        if p.ndim == 1:
-            return proba * self.csf.all_rewards(p) - (1 - proba) * self.d - self.r * (Ks + Kp)
-        elif p.ndim == 2:
-            return np.stack(
-                [
-                    proba_ * self.csf.all_rewards(p_) - (1 - proba_) * self.d - self.r * (Ks_ + Kp_)
-                    for proba_, p_, Ks_, Kp_ in zip(proba, p, Ks, Kp)
-                ]
-            )
-        else:
-            raise ValueError('Inputs must be 1- or 2-dimensional')
+        proba = (s / (1 + s)).prod(axis=-1, keepdims=True)
+        return proba * self.csf.all_rewards(p) - (1 - proba) * self.d - self.r * (Ks + Kp)
     
     def get_jac(self):
         prod_jacs = [self.prodFunc.get_jac(i) for i in range(self.n)]
@@ -234,14 +321,28 @@ class Problem:
             p_kp = prod_jac_[..., 1, 1]
             proba_ks = proba_mult * s_ks
             proba_kp = proba_mult * s_kp
-            R_ = self.csf.all_rewards(p)
-            R_deriv_ = self.csf.all_reward_derivs(p)
+            sum_ = p.sum(axis=-1)
+            R_ = self.csf.all_rewards(p, sum_)
+            R_deriv_ = self.csf.all_reward_derivs(p, sum_)
             return np.array([
                 proba_ks * (R_ + self.d) + proba * R_deriv_ * p_ks - self.r,
                 proba_kp * (R_ + self.d) + proba * R_deriv_ * p_kp - self.r
             ])
         return jac
     
+    def _get_roots_jac(self):
+        """Same as self.get_jac, but only for n x 2 strategies, and runs compiled code if numba is available"""
+        params = tuple(
+            np.ascontiguousarray(x, dtype=np.float64) for x in (
+                self.prodFunc.A, self.prodFunc.alpha, self.prodFunc.B, self.prodFunc.beta, self.prodFunc.theta,
+                self.d, self.r
+            )
+        )
+        csf_params = (float(self.csf.l), float(self.csf.a_l), float(self.csf._wl), float(self.csf._al))
+        def jac(x):
+            return _roots_jac_jit(x, *params, *csf_params)
+        return jac
+
     def _null_result(self) -> SolverResult:
         return SolverResult(
             False,
@@ -273,7 +374,7 @@ class Problem:
         return get_index(result, best)
 
     def _get_unique_results_with_roots_method(self, init_guesses: list) -> SolverResult:
-        jac = self.get_jac()
+        jac = self._get_roots_jac()
         # in nash equilibrium, all elements of the jacobian should be 0
         # try at multiple initial guesses to be more confident we're not finding local optimum
         results = np.empty((len(init_guesses), self.n, 2))
@@ -343,8 +444,9 @@ class HybridProblem(Problem):
             p_kp = prod_jac_[1, 1]
             proba_ks = proba_mult * s_ks
             proba_kp = proba_mult * s_kp
-            R_ = self.csf.reward(i, p)
-            R_deriv_ = self.csf.reward_deriv(i, p)
+            sum_ = p.sum(axis=-1)
+            R_ = self.csf.reward(i, p, sum_)
+            R_deriv_ = self.csf.reward_deriv(i, p, sum_)
             return -np.array([
                 proba_ks * (R_ + self.d[i]) + proba * R_deriv_ * p_ks - self.r[i],
                 proba_kp * (R_ + self.d[i]) + proba * R_deriv_ * p_kp - self.r[i]
@@ -430,7 +532,8 @@ class MixedProblem(Problem):
     def get_func(self, i: int):
         assert(self.hist.shape[0] > 0)
         def func(x):
-            self.hist[:, i] = np.repeat(x.reshape(1, -1), self.hist.shape[0], axis=0)
+            # broadcast x over history, rather than building a repeated copy
+            self.hist[:, i] = x
             return -self.net_payoff(i, self.hist[..., 0], self.hist[..., 1]).sum()
         return func
     
@@ -438,7 +541,7 @@ class MixedProblem(Problem):
         assert(self.hist.shape[0] > 0)
         prod_jac = self.prodFunc.get_jac(i)
         def jac(x):
-            self.hist[:, i, :] = np.repeat(x.reshape(1, -1), self.hist.shape[0], axis=0)
+            self.hist[:, i, :] = x
             s, p = self.prodFunc.F(self.hist[..., 0], self.hist[..., 1])
             probas = s / (1 + s)
             proba = probas.prod(axis=-1)
@@ -450,8 +553,9 @@ class MixedProblem(Problem):
             p_kp = prod_jac_[1, 1]
             proba_ks = proba_mult * s_ks
             proba_kp = proba_mult * s_kp
-            R_ = self.csf.reward(i, p)
-            R_deriv_ = self.csf.reward_deriv(i, p)
+            sum_ = p.sum(axis=-1)
+            R_ = self.csf.reward(i, p, sum_)
+            R_deriv_ = self.csf.reward_deriv(i, p, sum_)
             return -np.array([
                 proba_ks * (R_ + self.d[i]) + proba * R_deriv_ * p_ks - self.r[i],
                 proba_kp * (R_ + self.d[i]) + proba * R_deriv_ * p_kp - self.r[i]